@@ -10,15 +10,26 @@ from fastai.medical.imaging import *
 import numpy as np
 import pandas as pd
 import cv2
+# Decoding is faster with a dicomsdl build that has AVX2 enabled
 import dicomsdl as dicom
+from preprocess_ops import window_value, window_invert, histogram, apply_lut
+from numba import set_num_threads, get_num_threads
 from tqdm.notebook import tqdm, trange
-from joblib import Parallel, delayed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import aiofiles
+import threading
 import glob
 
 # %% preprocess.ipynb 3
 # Base class for preprocessing mammography images
 class MammoPreprocessorBase():
     
+    # Arrays written when saving with fformat="memmap"
+    _memmap_names = ("images",)
+    # Per thread buffers reused between images, see _scratch_buffer
+    _scratch = threading.local()
+    
     def __init__(self, img_path: str, 
                  image_size: tuple=(4096,2048), dir_name: str="Mammography_Dataset"):
         """
@@ -31,97 +42,213 @@ class MammoPreprocessorBase():
             os.makedirs(f"{dir_name}", exist_ok=True)
             self.save_path = os.path.join(os.getcwd(), dir_name)
         self.images = glob.glob(f"{img_path}/**/*.dcm", recursive=True)
+        # Use the SIMD (AVX2 on x86) code paths compiled into OpenCV, on by default in the opencv-python wheels since 4.x
+        cv2.setUseOptimized(True)
     
-    def preprocess_all(self, fformat: str, hist_eq: bool=True, n_jobs: int=-1, save=True):
+    def preprocess_all(self, fformat: str, hist_eq: bool=True, n_jobs: int=-1, save=True, prefetch: int=32):
         """
         Preprocesses all images in parallel. 
+        DICOM files are read asynchronously ahead of the worker processes, at most prefetch files are kept in memory.
         Applies histogram equalization if hist_eq=True, saves images if save=True.
+        With fformat="memmap" all images are written into one uint8 array of shape (N, *image_size) in images.dat, 
+        the paths and names of the images in the same order are saved to images.parquet.
         """
-        Parallel(n_jobs=n_jobs) \
-            (delayed(self.preprocess_image) \
-            (path, fformat, hist_eq, save) for path in tqdm(self.images, total=len(self.images)))
+        if save and fformat == "memmap":
+            self._create_memmaps()
+        coro = self._preprocess_all_async(fformat, hist_eq, n_jobs, save, prefetch)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(coro)
+        else:
+            # Jupyter already runs an event loop, so start a new one in a separate thread
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(asyncio.run, coro).result()
         print("Parallel preprocessing done!")
     
+    @staticmethod
+    def _init_worker():
+        # Images are already processed in parallel, so each worker runs OpenCV and Numba single threaded
+        cv2.setNumThreads(1)
+        set_num_threads(1)
     
-    def _hist_eq(self, img):
-        # Histogram equalization only works on 8-bit images
-        img = self._convert_to_8bit(img)
-        return cv2.equalizeHist(img)
+    def preprocess_bytes(self, buf: bytes, path: str, fformat: str="png", hist_eq: bool=True, save: bool=True, index: int=None):
+        """
+        Preprocesses an image from the already read bytes of its DICOM file.
+        The path is still needed to name the saved image.
+        """
+        return self.preprocess_image(path, fformat, hist_eq, save, buf=buf, index=index)
     
-    def _convert_to_8bit(self,img):
-        return (img / img.max()*255).astype(np.uint8)
+    async def _preprocess_all_async(self, fformat, hist_eq, n_jobs, save, prefetch):
+        
+        # Same convention as joblib: -1 uses all CPUs, -2 all but one, ...
+        n_workers = n_jobs if n_jobs > 0 else max(os.cpu_count() + 1 + n_jobs, 1)
+        # A slot is taken when a file is read and freed once its image is processed
+        slots = asyncio.Semaphore(prefetch)
+        queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        
+        async def read_files():
+            try:
+                for index, path in enumerate(self.images):
+                    await slots.acquire()
+                    async with aiofiles.open(path, "rb") as f:
+                        await queue.put((index, path, await f.read()))
+            finally:
+                # Always stop the consumer, a read error is raised when awaiting the reader
+                await queue.put(None)
+        
+        def on_done(future):
+            slots.release()
+            pbar.update()
+        
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=self._init_worker) as executor, tqdm(total=len(self.images)) as pbar:
+            reader = asyncio.create_task(read_files())
+            futures = []
+            while (item := await queue.get()) is not None:
+                index, path, buf = item
+                future = loop.run_in_executor(executor, self.preprocess_bytes, buf, path, fformat, hist_eq, save, index)
+                future.add_done_callback(on_done)
+                futures.append(future)
+            await reader
+            await asyncio.gather(*futures)
     
-    def _padresize_to_width(self, img, size, mask=None):
-        
-        h, w  = img.shape
+    def _write_image(self, save_path, img, fformat: str):
         
-        # If the width of the image is less than the desired width
-        if w < size[1]:
-            # Add padding to the right side of the image to reach the desired width
-            img = cv2.copyMakeBorder(img, 0, 0, 0, size[1] - w, cv2.BORDER_CONSTANT, value=(0, 0, 0))
-            if mask is not None:
-                mask = cv2.copyMakeBorder(mask, 0, 0, 0, size[1] - w, cv2.BORDER_CONSTANT, value=(0, 0, 0))
-        
-        # If the width of the image is greater than the desired width
-        if w > size[1]:
-            # Resize the image to the desired width
-            img = cv2.resize(img, (size[1], size[0]))
-            # Resize the mask if provided with interpolation set to nearest to keep pixel values
-            if mask is not None:
-                mask = cv2.resize(mask, (size[1], size[0]), interpolation = cv2.INTER_NEAREST)
-            
-        return (img, mask) if mask is not None else img
+        if fformat == "npy":
+            # Raw array without any encoding, fastest to write and to load for training
+            np.save(save_path, img)
+        elif fformat in ("jpg", "jpeg"):
+            cv2.imwrite(save_path, img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        else:
+            cv2.imwrite(save_path, img)
+    
+    def _image_table(self):
+        return pd.DataFrame({"path": self.images, 
+                             "fname": [self._RE_FNAME.search(path).group(1) for path in self.images]})
     
-    # Resize image but keep aspect ratio
-    def _resize_to_height(self, img, size, mask=None):
+    def _open_memmap(self, name: str, mode: str):
+        return np.memmap(os.path.join(self.save_path, f"{name}.dat"), dtype=np.uint8, mode=mode, 
+                         shape=(len(self.images), *self.image_size))
+    
+    def _create_memmaps(self):
         
-        h,w = img.shape
-        # Calculate aspect ratio
-        r = h/w
-        # Resize to desired height and calculate width to keep aspect ratio
-        new_size = (int(size[0]/r), size[0])
+        for name in self._memmap_names:
+            self._open_memmap(name, "w+").flush()
+        self._image_table().to_parquet(os.path.join(self.save_path, "images.parquet"))
+    
+    def _write_memmap(self, index: int, **arrays):
+        
+        # Without an index the image would be broadcast into every slot
+        if index is None:
+            raise ValueError('fformat="memmap" needs the index of the image, use preprocess_all')
+        # Each worker maps the file itself, only the pages of this image are written.
+        # The OS writes the shared pages back, no flush per image is needed
+        for name, arr in arrays.items():
+            self._open_memmap(name, "r+")[index] = arr
+    
+    def _load_dicom(self, path: str, buf: bytes=None):
+        # Use dicomsdl to open dcm files (faster than pydicom), from memory if the file was already read
+        dcmfile = dicom.open(path) if buf is None else dicom.open_memory(buf)
+        # Stored values skip dicomsdl's float rescale pass, only possible if the rescale is the identity
+        storedvalue = dcmfile.RescaleSlope in (None, 1) and dcmfile.RescaleIntercept in (None, 0)
+        img = dcmfile.pixelData(storedvalue=storedvalue)
+        # Maximum is returned so later steps don't have to reduce over the full image again
+        return dcmfile, img, img.max()
+    
+    
+    def _scratch_buffer(self, name: str, shape: tuple, dtype):
+        """
+        Returns an array of the given shape backed by a buffer of this thread that is reused between images.
+        The buffer only grows, the content is valid until the next call with the same name.
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        buf = getattr(self._scratch, name, None)
+        if buf is None or buf.size < nbytes:
+            buf = np.empty(nbytes, np.uint8)
+            setattr(self._scratch, name, buf)
+        return buf[:nbytes].view(dtype).reshape(shape)
+    
+    def _hist_eq(self, img):
+        # Equalize directly on the integer image with a LUT built from its histogram,
+        # floating point images (e.g. sigmoid windowing) still need the 8-bit conversion
+        if not np.issubdtype(img.dtype, np.unsignedinteger):
+            img = self._convert_to_8bit(img)
+
+        # The thread count is passed in, reading it inside the kernel prevents caching the compiled code
+        hist = histogram(img, get_num_threads())
+        # The darkest pixel value present is mapped to 0
+        first = np.flatnonzero(hist)[0]
+        cdf = np.cumsum(hist)
+        lut = ((cdf - cdf[first]) * 255 / max(cdf[-1] - cdf[first], 1)).clip(0, 255).astype(np.uint8)
+
+        return apply_lut(img, lut)
+    
+    def _convert_to_8bit(self, img, img_max=None):
+        if img_max is None:
+            # OpenCV's SIMD reduction, returns the maximum as a Python float
+            img_max = cv2.minMaxLoc(img)[1]
+        # Scales and saturates to uint8 in one pass, without a float64 intermediate
+        # An all black image would give an infinite scale
+        return cv2.convertScaleAbs(img, alpha=255.0/float(img_max) if img_max > 0 else 0.0)
+    
+    def _fit_into(self, img, size, mask=None, out=None):
+        """
+        Resizes to the desired height keeping the aspect ratio and pads the right side up to the desired width, 
+        wider images are squeezed to the width. Resizes straight into one preallocated array, 
+        out can be given to reuse a buffer for the image.
+        """
+        h, w = img.shape
+        new_h, new_w = size[0], min(size[1], int(size[0]*w/h))
         
+        # Only the padding has to be cleared, the rest is written by the resize
+        if out is None:
+            out = np.empty(size, dtype=img.dtype)
+        out[:, new_w:] = 0
         # cv2.resize takes image size in form (width, height)
-        img = cv2.resize(img, new_size)
+        cv2.resize(img, (new_w, new_h), dst=out[:new_h, :new_w], interpolation=cv2.INTER_AREA)
         if mask is not None:
             # Use nearest interpolation to keep mask pixel values
-            mask = cv2.resize(mask, new_size, interpolation = cv2.INTER_NEAREST)
+            out_mask = np.empty(size, dtype=mask.dtype)
+            out_mask[:, new_w:] = 0
+            cv2.resize(mask, (new_w, new_h), dst=out_mask[:new_h, :new_w], interpolation=cv2.INTER_NEAREST)
         
-        return (img, mask) if mask is not None else img
+        return (out, out_mask) if mask is not None else out
     
-    def _crop_roi(self, img, mask=None):
-        
-        # Binarize image to remove background noise
-        bin_img = self._binarize(img)
-        # Find the largest contour
+    def _roi_pipeline(self, img, mask=None, img_max=None):
+        """
+        Removes the background, crops to the breast and flips it to the left side.
+        Binarizes and searches for the largest contour only once for all three steps.
+        """
+        bin_img = self._binarize(img, img_max, out=self._scratch_buffer("bin", img.shape, np.uint8))
         contour = self._find_contours(bin_img)
-        
+
         # Create a bounding box from the contour
-        x1, x2 = np.min(contour[:, :, 0]), np.max(contour[:, :, 0])
-        y1, y2 = np.min(contour[:, :, 1]), np.max(contour[:, :, 1])
-        
-        # Use bounding box coordinates to crop the image and mask if provided
-        return (img[y1:y2, x1:x2], mask[y1:y2, x1:x2]) if mask is not None else img[y1:y2, x1:x2] 
-        
-    def _remove_background(self, img, remove_wlines=False):
-        # find a better solution to remove horizontal white lines
-        
-        # Binarize image to remove noise and find the largest contour
-        bin_img = self._binarize(img)
-        contour = self._find_contours(bin_img)
-        
-        # Create a mask from the contour
-        mask = np.zeros(bin_img.shape, np.uint8)
-        cv2.drawContours(mask, [contour], -1, 255, cv2.FILLED)
-        
-        # Not working most of the time
-        if remove_wlines:
-            white_lines_fix = (mask[:,-1]!=255).astype(np.uint8)[:,None]
-            mask = (mask * white_lines_fix) / mask.max()
-        
-        # Multiply the image with the black and white 
-        return img * mask
-    
+        x1, y1, w, h = cv2.boundingRect(contour)
+        x2, y2 = x1 + w, y1 + h
+
+        # Draw the contour mask only inside the bounding box
+        mask_roi = self._scratch_buffer("mask", (h, w), np.uint8)
+        mask_roi.fill(0)
+        cv2.drawContours(mask_roi, [contour], -1, 1, cv2.FILLED, offset=(-x1, -y1))
+        img = img[y1:y2, x1:x2]
+        img = cv2.bitwise_and(img, img, mask=mask_roi)
+        if mask is not None:
+            mask = mask[y1:y2, x1:x2]
+
+        # Determine where the breast is by comparing the pixel values of the masked crop halves,
+        # the binarized image can't be used as the whole frame may be above the threshold
+        w_half = img.shape[1] // 2
+        left_col_sum = cv2.sumElems(img[:, :w_half])[0]
+        right_col_sum = cv2.sumElems(img[:, w_half:])[0]
+        # Flip if breast on the right
+        if left_col_sum < right_col_sum:
+            img = np.fliplr(img)
+            if mask is not None:
+                mask = np.fliplr(mask)
+
+        return (img, mask) if mask is not None else img
+
     def _find_contours(self, bin_img):
     
         contours, _ = cv2.findContours(bin_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
@@ -130,33 +257,29 @@ class MammoPreprocessorBase():
 
         return contour
     
-    def _binarize(self, img):
+    def _binarize(self, img, img_max=None, out=None):
         
+        if img_max is None:
+            img_max = img.max()
         # Binarize the image with a 5% threshold
-        binarized = (img > (img.max()*0.05)).astype("uint8")
-        
-        return binarized
-
-    def _correct_side(self, img, mask=None):
+        if out is None:
+            return (img > (img_max*0.05)).astype("uint8")
+        # Write the comparison as 0/1 bytes straight into the uint8 buffer
+        np.greater(img, img_max*0.05, out=out.view(bool))
         
-        # Split image symetrically
-        col_sums_split = np.array_split(np.sum(img, axis=0), 2)
-        # Sum the pixel values on each side
-        left_col_sum = np.sum(col_sums_split[0])
-        right_col_sum = np.sum(col_sums_split[1])
-
-        # Determine where the breast is by comparing total pixel values
-        if left_col_sum > right_col_sum: 
-            return (img, mask) if mask is not None else img
-        # Flip if breast on the right
-        else: 
-            return (np.fliplr(img), np.fliplr(mask)) if mask is not None else np.fliplr(img)
+        return out
 
 # %% preprocess.ipynb 4
 # Class for preprocessing mammography images from CBIS-DDSM
 # Inherits most methods from base class
 class MammoPreprocessorCBISDDSM(MammoPreprocessorBase):
     
+    _memmap_names = ("images", "masks")
+    
+    # Patterns to extract file and patient names from image paths
+    _RE_FNAME = re.compile(r"/.+/(.+_P_[0-9]+_.+?)/")
+    _RE_PATIENT = re.compile(r"_(P_[0-9]+)_")
+    
     def __init__(self, img_path: str, masks: str=None, 
                mammo_imgs_csv: str=None, masks_csv: str=None, case_desc_csv: str=None,
               image_size: tuple=(4096,2048), dir_name: str="CBIS_DDSM"):
@@ -164,30 +287,33 @@ class MammoPreprocessorCBISDDSM(MammoPreprocessorBase):
         super().__init__(img_path, image_size, dir_name)
         # Cleaning and merging the datasets that came with the images
         self.df = self._merge_dfs(mammo_imgs_csv, masks_csv, case_desc_csv)
+        # Index the abnormalities by image once, instead of filtering the dataframe for every image.
+        # Plain tuples and arrays keep the preprocessor cheap to pickle for the worker processes
+        self._masks_by_path = {path: (tuple(group.mask_fname), group.pathology.to_numpy(np.uint8))
+                               for path, group in self.df.groupby("full_img_fname", sort=False)}
         
-    def preprocess_image(self, path:str, fformat: str="png", hist_eq: bool=True, save: bool=True):
+    def preprocess_image(self, path:str, fformat: str="png", hist_eq: bool=True, save: bool=True, 
+                         buf: bytes=None, index: int=None):
         
-        # Use dicomsdl to open dcm files (faster than pydicom)
-        img = dicom.open(path).pixelData()
+        _, img, img_max = super()._load_dicom(path, buf)
         # Each abnormality has a seperate mask so combine then into one for each image
         labels = self._combine_masks(path)
         
-        img, labels = super()._correct_side(img, labels)
-        img = super()._remove_background(img)
-        img, labels = super()._crop_roi(img, labels)
-        img, labels = super()._resize_to_height(img, self.image_size, labels)
-        img, labels = super()._padresize_to_width(img, self.image_size, labels)
+        img, labels = super()._roi_pipeline(img, labels, img_max)
+        # The resized image is only an intermediate, the 8-bit conversion creates a new array
+        padded = super()._scratch_buffer("padded", self.image_size, img.dtype)
+        img, labels = super()._fit_into(img, self.image_size, labels, out=padded)
         if hist_eq:
             img = super()._hist_eq(img)
         else:
             img = super()._convert_to_8bit(img)
         
         if save:
-            self._save_image(img, path, fformat=fformat, mask=labels)
+            self._save_image(img, path, fformat=fformat, mask=labels, index=index)
         else: 
             return img
         
-    def _save_image(self, img, path, fformat: str, mask=None):
+    def _save_image(self, img, path, fformat: str, mask=None, index: int=None):
         """
         Naming convention:
         Mass-Training_P_00001_LEFT_MLO_mammo.png
@@ -195,12 +321,16 @@ class MammoPreprocessorCBISDDSM(MammoPreprocessorBase):
         Lesion type/train or test/patient id/left or right breast/view/mask or image/exstension
         """
         
+        if fformat == "memmap":
+            super()._write_memmap(index, images=img, masks=mask)
+            return
+        
         dir_path = self._create_save_path(path)
-        fname = re.search("/.+/(.+_P_[0-9]+_.+?)/", path).group(1)
+        fname = self._RE_FNAME.search(path).group(1)
         
         fname_img = f"{fname}_mammo.{fformat}"
         save_path = os.path.join(dir_path, fname_img)
-        cv2.imwrite(save_path, img)
+        super()._write_image(save_path, img, fformat)
         
         if mask is not None:
             fname_mask = f"{fname}_mask.png"
@@ -210,25 +340,39 @@ class MammoPreprocessorCBISDDSM(MammoPreprocessorBase):
     def _create_save_path(self, img_path):
  
         # Create a folder from patient id    
-        patient_folder = re.search("_(P_[0-9]+)_", img_path).group(1)
+        patient_folder = self._RE_PATIENT.search(img_path).group(1)
         
         save_path = os.path.join(self.save_path, patient_folder)
         os.makedirs(save_path, exist_ok=True)
         
         return save_path
 
+    def _image_table(self):
+        
+        df = super()._image_table()
+        # Most severe pathology in the image: 0 for none, 1 for benign, 2 for malignant
+        df["pathology"] = [self._masks_by_path[path][1].max() if path in self._masks_by_path else 0 
+                           for path in self.images]
+        return df
+
     def _combine_masks(self, path):
 
-        image_info = self.df.loc[self.df.full_img_fname==path]
+        image_info = self._masks_by_path.get(path)
+        if image_info is None:
+            return 0
+        mask_fnames, pathologies = image_info
 
-        labels = 0
-        for i in range(image_info.shape[0]):
-            mask = image_info.iloc[i]
-            mask_px = (dicom.open(mask.mask_fname).pixelData() / 255).astype(np.uint8)
-            # Mask are coded: 1 for benign, 2 for malignant
-            labels += mask_px * mask.pathology
+        # dicomsdl releases the GIL while decoding, so the masks are read in threads
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            masks = list(executor.map(self._load_mask, mask_fnames))
 
-        return labels
+        # Mask are coded: 1 for benign, 2 for malignant, overlapping abnormalities keep the most severe code
+        masks = np.stack(masks)
+        masks *= pathologies[:, None, None]
+        return np.maximum.reduce(masks, axis=0)
+    
+    def _load_mask(self, path):
+        return (dicom.open(path).pixelData(storedvalue=True) // 255).astype(np.uint8)
     
     def _merge_dfs(self, mammo_imgs_csv, masks_csv, case_desc_csv):
         
@@ -267,45 +411,157 @@ class MammoPreprocessorCBISDDSM(MammoPreprocessorBase):
 # %% preprocess.ipynb 5
 class MammoPreprocessorRSNA(MammoPreprocessorBase):
     
-    def __init__(self, img_path: str, 
-                 image_size: tuple=(4096,2048), dir_name: str="RSNA"):
+    # Patterns to extract file and patient names from image paths
+    _RE_FNAME = re.compile(r"/([0-9]+)\.dcm$")
+    _RE_PATIENT = re.compile(r"/([0-9]+)/")
+    # GPU decoder, created when first used
+    _decoder = None
+    # JPEG 2000 and High-Throughput JPEG 2000 transfer syntaxes, decoded by nvJPEG2000
+    _J2K_TRANSFER_SYNTAXES = ("1.2.840.10008.1.2.4.90", "1.2.840.10008.1.2.4.91", 
+                              "1.2.840.10008.1.2.4.201", "1.2.840.10008.1.2.4.202", "1.2.840.10008.1.2.4.203")
     
+    def __init__(self, img_path: str, 
+                 image_size: tuple=(4096,2048), dir_name: str="RSNA", gpu: bool=False):
+        """
+        With gpu=True JPEG2000 images are decoded with nvJPEG2000 (through nvImageCodec) 
+        and processed with CuPy, this needs both packages and a CUDA device. 
+        Use few n_jobs in preprocess_all, every worker process creates its own CUDA context.
+        """
         super().__init__(img_path, image_size, dir_name)
+        self.gpu = gpu
         
-    def preprocess_image(self, path:str, fformat: str="png", hist_eq: bool=True, save=True):
+    def preprocess_image(self, path:str, fformat: str="png", hist_eq: bool=True, save=True, 
+                         buf: bytes=None, index: int=None):
         
-        scan, img = self._load_dicom(path)
-        
-        img = self._fix_photometric_inter(scan, img)
-        img = self._windowing(scan, img)
-        img = super()._correct_side(img)
-        img = super()._remove_background(img)
-        img = super()._crop_roi(img)
-        img = super()._resize_to_height(img, self.image_size)
-        img = super()._padresize_to_width(img, self.image_size)
-        if hist_eq:
-            img = super()._hist_eq(img)
+        if self.gpu:
+            img = self._preprocess_image_gpu(path, buf, hist_eq)
         else:
-            img = super()._convert_to_8bit(img)
+            scan, img, img_max = super()._load_dicom(path, buf)
+            
+            # Photometric fix and windowing in a single pass, the result is uint16
+            sigmoid, center, width, y_range = self._window_params(scan)
+            img = window_invert(img, img_max, center, width, y_range,
+                                scan.PhotometricInterpretation == "MONOCHROME1", sigmoid)
+            img = super()._roi_pipeline(img)
+            # The resized image is only an intermediate, the 8-bit conversion creates a new array
+            padded = super()._scratch_buffer("padded", self.image_size, img.dtype)
+            img = super()._fit_into(img, self.image_size, out=padded)
+            if hist_eq:
+                img = super()._hist_eq(img)
+            else:
+                img = super()._convert_to_8bit(img)
         
         if save:
-            self._save_image(img, path, fformat=fformat)
+            self._save_image(img, path, fformat=fformat, index=index)
         else:
             return img
         
-    def _save_image(self, img, path, fformat: str):
+    def _preprocess_image_gpu(self, path: str, buf: bytes, hist_eq: bool):
+        """
+        Same steps as preprocess_image but on the GPU, only the contour search runs on the CPU.
+        Returns the final uint8 image on the host.
+        """
+        import cupy as cp
+        from cupyx.scipy import ndimage
+        
+        if buf is None:
+            with open(path, "rb") as f:
+                buf = f.read()
+        scan = dicom.open_memory(buf)
+        
+        # Both branches give the stored values
+        if self._is_j2k(scan):
+            # The pixel sequence joins the fragments of the frame into one codestream
+            frame = scan.getDataElement("PixelData").toPixelSequence().encodedFrameData(0)
+            img = cp.asarray(self._gpu_decoder().decode(frame, params=self._gpu_decode_params()))[..., 0]
+        else:
+            img = cp.asarray(scan.pixelData(storedvalue=True))
+        img = img.astype(cp.float32)
+        
+        # Modality rescale, as dicomsdl applies it on the CPU path
+        slope, intercept = scan.RescaleSlope, scan.RescaleIntercept
+        if slope not in (None, 1) or intercept not in (None, 0):
+            img = img * (1 if slope is None else slope) + (0 if intercept is None else intercept)
+        
+        # Section C.7.6.3.1.2
+        if scan.PhotometricInterpretation == "MONOCHROME1":
+            img = img.max() - img
+        
+        # NumPy's ufuncs in window_value dispatch to CuPy
+        img = window_value(img, *self._window_params(scan))
+        
+        # Only the binarized image is moved to the host to find the largest contour
+        bin_img = (img > img.max()*0.05).astype(cp.uint8)
+        contour = super()._find_contours(cp.asnumpy(bin_img))
+        x1, y1, w, h = cv2.boundingRect(contour)
+        mask_roi = np.zeros((h, w), np.uint8)
+        cv2.drawContours(mask_roi, [contour], -1, 1, cv2.FILLED, offset=(-x1, -y1))
+        img = img[y1:y1+h, x1:x1+w] * cp.asarray(mask_roi)
+        
+        # Flip if breast on the right, decided from the pixel values like _roi_pipeline
+        w_half = img.shape[1] // 2
+        if float(img[:, :w_half].sum()) < float(img[:, w_half:].sum()):
+            img = cp.fliplr(img)
+        
+        # Resize to the desired height keeping the aspect ratio, pad the right side to the desired width
+        size = self.image_size
+        new_h, new_w = size[0], min(size[1], int(size[0]*w/h))
+        out = cp.zeros(size, dtype=cp.float32)
+        out[:new_h, :new_w] = ndimage.zoom(img, (new_h/h, new_w/w), order=1)
+        
+        if hist_eq:
+            out = cp.rint(out).astype(cp.uint16)
+            hist = cp.bincount(out.ravel(), minlength=1<<16)
+            first = int(cp.flatnonzero(hist)[0])
+            cdf = cp.cumsum(hist)
+            lut = ((cdf - cdf[first]) * 255 / max(int(cdf[-1] - cdf[first]), 1)).clip(0, 255).astype(cp.uint8)
+            out = lut[out]
+        else:
+            # An all black image would give an infinite scale
+            out_max = float(out.max())
+            out = (out * (255.0 / out_max if out_max > 0 else 0.0)).astype(cp.uint8)
+        
+        return cp.asnumpy(out)
+    
+    @classmethod
+    def _is_j2k(cls, scan):
+        # getTransferSyntax() returns dicomsdl's UID enum, which has no HTJ2K members, so compare the UID string
+        return str(scan.TransferSyntaxUID) in cls._J2K_TRANSFER_SYNTAXES
+    
+    @classmethod
+    def _gpu_decoder(cls):
+        # One decoder per process, kept on the class so it isn't pickled with the preprocessor
+        if cls._decoder is None:
+            from nvidia import nvimgcodec
+            cls._decoder = nvimgcodec.Decoder()
+        return cls._decoder
+    
+    @staticmethod
+    def _gpu_decode_params():
+        from nvidia import nvimgcodec
+        # Keep the single channel and full bit depth of the stored image
+        return nvimgcodec.DecodeParams(color_spec=nvimgcodec.ColorSpec.UNCHANGED, allow_any_depth=True)
+    
+    def _save_image(self, img, path, fformat: str, index: int=None):
+        
+        if fformat == "memmap":
+            super()._write_memmap(index, images=img)
+            return
         
         dir_path = self._create_save_path(path)
-        fname = re.search("/([0-9]+).dcm$", path).group(1)
+        fname = self._RE_FNAME.search(path).group(1)
         
         fname_img = f"{fname}.{fformat}"
         save_path = os.path.join(dir_path, fname_img)
-        cv2.imwrite(save_path, img)
+        super()._write_image(save_path, img, fformat)
     
     # https://dicom.nema.org/medical/dicom/2018b/output/chtml/part03/sect_C.11.2.html
-    def _windowing(self, scan, img):
-        
-        function = scan.VOILUTFunction
+    def _window_params(self, scan):
+        """
+        Returns whether the VOI LUT function is SIGMOID, the window center and width and the output range, 
+        as expected by window_value and window_invert.
+        """
+        sigmoid = scan.VOILUTFunction == 'SIGMOID'
         
         if type(scan.WindowWidth) == list:
             center = int(np.mean((scan.WindowCenter)))
@@ -316,41 +572,17 @@ class MammoPreprocessorRSNA(MammoPreprocessorBase):
         
         y_range = 2**scan.BitsStored - 1
         
-        if function == 'SIGMOID':
-            img = y_range / (1 + np.exp(-4 * (img - center) / width))
-        
-        else: # LINEAR
-            
+        if not sigmoid: # LINEAR
             center -= 0.5
             width -= 1
-            
-            below = img <= (center - width / 2)
-            above = img > (center + width / 2)
-            between = np.logical_and(~below, ~above)
-            img[below] = 0
-            img[above] = y_range
-            img[between] = ((img[between] - center) / width + 0.5) * y_range
         
-        return img
-    
-    # https://dicom.nema.org/medical/Dicom/2017c/output/chtml/part03/sect_C.7.6.3.html
-    def _fix_photometric_inter(self, scan, img):
-        
-        # Section C.7.6.3.1.2
-        if scan.PhotometricInterpretation == "MONOCHROME1":
-            img = img.max() - img
-            
-        return img
+        return sigmoid, float(center), float(width), float(y_range)
     
     def _create_save_path(self, img_path):
  
-        patient_folder = re.search("/([0-9]+)/", img_path).group(1)
+        patient_folder = self._RE_PATIENT.search(img_path).group(1)
         
         save_path = os.path.join(self.save_path, patient_folder)
         os.makedirs(save_path, exist_ok=True)
         
         return save_path
-    
-    def _load_dicom(self, path: str):
-        dcmfile = dicom.open(path)
-        return dcmfile, dcmfile.pixelData()
@@ -0,0 +1,78 @@
+# Plain module, edit this file directly. It isn't exported by nbdev like preprocess.py, 
+# which imports it (source: the export cells of Notebooks/preprocessing-script.ipynb).
+
+__all__ = ['window_value', 'window_invert', 'histogram', 'apply_lut']
+
+import numpy as np
+from numba import njit, prange
+from numba.extending import register_jitable
+
+# Numba kernels for the per-pixel steps of preprocessing.
+# Each kernel does a single sweep over the image rows in parallel, without numpy temporaries.
+
+# https://dicom.nema.org/medical/dicom/2018b/output/chtml/part03/sect_C.11.2.html
+@register_jitable
+def window_value(x, sigmoid, center, width, y_range):
+    """
+    VOI LUT windowing of a single value inside Numba kernels, or of a whole NumPy or CuPy array when called from Python.
+    For LINEAR the center and width must already be adjusted by -0.5 and -1.
+    """
+    if sigmoid:
+        return y_range / (1 + np.exp(-4 * (x - center) / width))
+    # LINEAR, values below the window become 0 and values above y_range
+    return np.minimum(np.maximum(x - (center - width / 2), 0.0), width) * (y_range / width)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def window_invert(img, img_max, center, width, y_range, monochrome1, sigmoid):
+    """
+    Inverts MONOCHROME1 images and applies the VOI LUT windowing in one pass.
+    Returns the windowed image as uint16 in the range [0, y_range].
+    """
+    h, w = img.shape
+    out = np.empty((h, w), np.uint16)
+
+    for i in prange(h):
+        for j in range(w):
+            x = np.float32(img[i, j])
+            # Section C.7.6.3.1.2
+            if monochrome1:
+                x = img_max - x
+            out[i, j] = np.uint16(window_value(x, sigmoid, center, width, y_range) + 0.5)
+
+    return out
+
+@njit(parallel=True, cache=True)
+def histogram(img, n_chunks):
+    """
+    Histogram with 2**16 bins of an 8 or 16-bit image.
+    The rows are split into n_chunks blocks (usually the number of threads) that are counted into 
+    their own histograms, these are summed at the end.
+    """
+    h, w = img.shape
+    n_chunks = max(min(n_chunks, h), 1)
+    rows = (h + n_chunks - 1) // n_chunks
+    partial = np.zeros((n_chunks, 1 << 16), np.int64)
+
+    for c in prange(n_chunks):
+        for i in range(c * rows, min((c + 1) * rows, h)):
+            for j in range(w):
+                partial[c, img[i, j]] += 1
+
+    hist = np.zeros(1 << 16, np.int64)
+    for b in prange(1 << 16):
+        for c in range(n_chunks):
+            hist[b] += partial[c, b]
+
+    return hist
+
+@njit(parallel=True, cache=True)
+def apply_lut(img, lut):
+
+    h, w = img.shape
+    out = np.empty((h, w), lut.dtype)
+
+    for i in prange(h):
+        for j in range(w):
+            out[i, j] = lut[img[i, j]]
+
+    return out
@@ -0,0 +1,19 @@
+from types import SimpleNamespace
+
+import pytest
+
+# preprocess imports the full preprocessing stack at module level
+for module in ("fastai", "cv2", "dicomsdl", "numba", "aiofiles"):
+    pytest.importorskip(module)
+
+from preprocess import MammoPreprocessorRSNA
+
+
+@pytest.mark.parametrize("uid", ["1.2.840.10008.1.2.4.90", "1.2.840.10008.1.2.4.91", "1.2.840.10008.1.2.4.201"])
+def test_j2k_transfer_syntax_uses_gpu_decoder(uid):
+    assert MammoPreprocessorRSNA._is_j2k(SimpleNamespace(TransferSyntaxUID=uid))
+
+
+@pytest.mark.parametrize("uid", ["1.2.840.10008.1.2.1", "1.2.840.10008.1.2.4.70"])
+def test_other_transfer_syntax_uses_cpu_decoder(uid):
+    assert not MammoPreprocessorRSNA._is_j2k(SimpleNamespace(TransferSyntaxUID=uid))